@@ -1,14 +1,82 @@
 import os
+import re
 from pathlib import Path
-from flask import Flask
+from flask import Flask, g, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_caching import Cache
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
 from flask_login import LoginManager
 from itsdangerous import URLSafeTimedSerializer
 from dotenv import load_dotenv
 
+
+# uploads saved by unique_upload_name(): uploads/<uuid4 hex><ext>
+_UUID_UPLOAD = re.compile(r"uploads/[0-9a-f]{32}(\.[A-Za-z0-9]+)?")
+
+
+class MyShop(Flask):
+    def get_send_file_max_age(self, filename):
+        # uuid-named uploads never change, so they can be cached for good
+        if filename and _UUID_UPLOAD.fullmatch(filename):
+            return self.config["UPLOAD_MAX_AGE"]
+        return super().get_send_file_max_age(filename)
+
+
+def _set_sqlite_pragmas(dbapi_conn, conn_record):
+    # WAL lets readers keep going while a write commits; the rest trims fsyncs and disk reads
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")  # 256MB
+    cur.execute("PRAGMA cache_size=-65536")  # 64MB
+    cur.close()
+
+
+def _raise_on_lazy_load(orm_execute_state):
+    # a lazy="select" load inside a request means a view or template missed an eager load (N+1);
+    # selectinload() and eager relationships (lazy="selectin", also on refresh) are let through
+    if not has_request_context():
+        return
+    if not orm_execute_state.is_relationship_load or orm_execute_state.lazy_loaded_from is None:
+        return
+    prop = orm_execute_state.loader_strategy_path.prop
+    if prop.lazy in ("select", True):
+        raise InvalidRequestError(
+            f"lazy load of {prop} during a request; eager-load it in the query (e.g. selectinload)"
+        )
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+
+
+def install_query_guard(app):
+    """Dev/CI guard against N+1 regressions: raise on lazy loads, flag requests past QUERY_BUDGET."""
+    event.listen(db.session, "do_orm_execute", _raise_on_lazy_load)
+    event.listen(db.engine, "before_cursor_execute", _count_query)
+
+    @app.after_request
+    def _check_query_budget(response):
+        count = g.get("query_count", 0)
+        if count > app.config["QUERY_BUDGET"]:
+            message = "%s %s ran %d queries (budget %d)" % (
+                request.method, request.path, count, app.config["QUERY_BUDGET"],
+            )
+            # fail loudly under tests so CI catches the regression
+            if app.testing:
+                raise AssertionError(message)
+            app.logger.warning(message)
+        return response
+
+
 # --- Extensions ---
 db = SQLAlchemy()
 login_manager = LoginManager()
+cache = Cache()
 serializer = None
 
 
@@ -19,7 +87,7 @@ def create_app():
     UPLOAD_FOLDER = BASE_DIR / "static" / "uploads"
     UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
 
-    app = Flask(__name__, static_folder="static", template_folder="templates")
+    app = MyShop(__name__, static_folder="static", template_folder="templates")
 
     # --- Config ---
     app.config["SECRET_KEY"] = os.environ.get("MYSHOP_SECRET", "dev-secret-key")
@@ -29,6 +97,19 @@ def create_app():
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     app.config["UPLOAD_FOLDER"] = str(UPLOAD_FOLDER)
     app.config["MAX_CONTENT_LENGTH"] = 8 * 1024 * 1024  # 8MB limit
+    app.config["UPLOAD_MAX_AGE"] = 365 * 24 * 60 * 60  # 1 year
+    # Apache (mod_xsendfile) / lighttpd only: they serve the file named in the X-Sendfile header.
+    # nginx ignores that header and would send empty bodies, so leave this off behind nginx.
+    app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE", "False") == "True"
+
+    # --- Query guard (enable in dev/CI to catch N+1 regressions) ---
+    app.config["QUERY_GUARD"] = os.environ.get("QUERY_GUARD", "False") == "True"
+    app.config["QUERY_BUDGET"] = int(os.environ.get("QUERY_BUDGET") or 10)
+
+    # --- Cache Config (use RedisCache + CACHE_REDIS_URL with several workers) ---
+    app.config["CACHE_TYPE"] = os.environ.get("CACHE_TYPE", "SimpleCache")
+    app.config["CACHE_REDIS_URL"] = os.environ.get("CACHE_REDIS_URL")
+    app.config["CACHE_DEFAULT_TIMEOUT"] = 60
 
     # --- Mail Config ---
     app.config["MAIL_SERVER"] = os.environ.get("MAIL_SERVER")
@@ -38,10 +119,18 @@ def create_app():
     app.config["MAIL_USE_TLS"] = os.environ.get("MAIL_USE_TLS", "True") == "True"
     app.config["MAIL_DEFAULT_SENDER"] = os.environ.get("MAIL_DEFAULT_SENDER", "no-reply@myshop.local")
 
+    # --- Templates: share compiled bytecode between workers and restarts ---
+    # (auto-reload stays tied to debug mode, so production skips the per-render stat calls)
+    jinja_cache_dir = os.environ.get("JINJA_CACHE_DIR")
+    if jinja_cache_dir:
+        Path(jinja_cache_dir).mkdir(parents=True, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(jinja_cache_dir)
+
     # --- Initialize extensions ---
     db.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = "login"
+    cache.init_app(app)
 
     global serializer
     serializer = URLSafeTimedSerializer(app.config["SECRET_KEY"])
@@ -51,6 +140,28 @@ def create_app():
     routes.register_routes(app)
 
     with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            event.listen(db.engine, "connect", _set_sqlite_pragmas)
         db.create_all()
+        from app.models import create_product_fts, merge_duplicate_cart_rows, product_categories
+        # the unique cart index can't be built while older duplicate rows exist
+        merge_duplicate_cart_rows()
+        # create_all() skips existing tables, so add indexes introduced since
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+
+        create_product_fts()
+
+        # databases from before the Category table have products but no links yet
+        if db.session.query(product_categories).first() is None:
+            try:
+                routes.backfill_product_categories()
+            except IntegrityError:
+                # another worker backfilled at the same time
+                db.session.rollback()
+
+        if app.config["QUERY_GUARD"]:
+            install_query_guard(app)
 
     return app
@@ -1,9 +1,16 @@
-from datetime import datetime
+from datetime import datetime, timezone
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import func, inspect, text
 from app import db
 
 
+def utcnow():
+    # datetime.utcnow() is deprecated as of Python 3.12; the columns are naive
+    # db.DateTime, so store naive UTC to match what the database hands back
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(255), unique=True, nullable=False)
@@ -16,39 +23,70 @@ class User(db.Model, UserMixin):
     city = db.Column(db.String(100))
     address = db.Column(db.Text)
     zip_code = db.Column(db.String(20))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=utcnow)
 
     orders = db.relationship("Order", backref="user", lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, method="scrypt", salt_length=16)
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def needs_rehash(self):
+        # hashes created before the switch to scrypt are upgraded on login
+        return self.password_hash.startswith("pbkdf2:")
+
+
+product_categories = db.Table(
+    "product_categories",
+    db.Column("product_id", db.Integer, db.ForeignKey("product.id"), primary_key=True),
+    db.Column("category_id", db.Integer, db.ForeignKey("category.id"), primary_key=True),
+    db.Index("ix_pc_cat", "category_id", "product_id"),
+)
+
+
+class Category(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False, index=True)
+
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text)
     specifications = db.Column(db.Text)
-    categories = db.Column(db.String(500))
+    categories = db.Column(db.String(500))  # display copy; filter through category_list
     price = db.Column(db.Float, default=0.0)
     main_image = db.Column(db.String(500))
     image2 = db.Column(db.String(500))
     image3 = db.Column(db.String(500))
     image4 = db.Column(db.String(500))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=utcnow)
+
+    cart_items = db.relationship("Cart", back_populates="product", lazy=True)
+    category_list = db.relationship("Category", secondary=product_categories, backref="products")
+    comments = db.relationship(
+        "Comment", backref="product", lazy="select", order_by="Comment.created_at.desc()"
+    )
+
+
+# keyset pagination on /products walks this index newest first
+db.Index("ix_product_created_id", Product.created_at.desc(), Product.id.desc())
 
 
 class Cart(db.Model):
+    # one row per (user, product); cart_add upserts against this index
+    __table_args__ = (db.Index("ix_cart_user_product", "user_id", "product_id", unique=True),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey("product.id"), nullable=False)
     quantity = db.Column(db.Integer, default=1)
-    added_at = db.Column(db.DateTime, default=datetime.utcnow)
+    added_at = db.Column(db.DateTime, default=utcnow)
 
-    product = db.relationship("Product", backref="cart_items", lazy=True)
+    # lazy="raise" so every route has to eager-load the product explicitly
+    product = db.relationship("Product", back_populates="cart_items", lazy="raise")
 
 
 class Order(db.Model):
@@ -58,9 +96,10 @@ class Order(db.Model):
     total_amount = db.Column(db.Float, default=0.0)
     shipping = db.Column(db.Float, default=0.0)
     status = db.Column(db.String(50), default="Pending")
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=utcnow)
 
-    items = db.relationship("OrderItem", backref="order", lazy=True)
+    # order pages always list the items, so load them with the order
+    items = db.relationship("OrderItem", back_populates="order", lazy="selectin")
 
 
 class OrderItem(db.Model):
@@ -72,6 +111,9 @@ class OrderItem(db.Model):
     unit_price = db.Column(db.Float)
     quantity = db.Column(db.Integer, default=1)
 
+    order = db.relationship("Order", back_populates="items")
+    product = db.relationship("Product")
+
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -79,4 +121,61 @@ class Comment(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     name = db.Column(db.String(120))
     body = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=utcnow)
+
+
+# Full-text index over products for /search (SQLite FTS5, kept in sync by triggers)
+PRODUCT_FTS_DDL = [
+    """CREATE VIRTUAL TABLE products_fts USING fts5(
+        name, description, categories, content='product', content_rowid='id'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_ai AFTER INSERT ON product BEGIN
+        INSERT INTO products_fts(rowid, name, description, categories)
+        VALUES (new.id, new.name, new.description, new.categories);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_ad AFTER DELETE ON product BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description, categories)
+        VALUES ('delete', old.id, old.name, old.description, old.categories);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_au AFTER UPDATE ON product BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description, categories)
+        VALUES ('delete', old.id, old.name, old.description, old.categories);
+        INSERT INTO products_fts(rowid, name, description, categories)
+        VALUES (new.id, new.name, new.description, new.categories);
+    END""",
+]
+
+
+def merge_duplicate_cart_rows():
+    """Folds duplicate (user_id, product_id) cart rows into one before ix_cart_user_product exists."""
+    existing = {ix["name"] for ix in inspect(db.engine).get_indexes("cart")}
+    if "ix_cart_user_product" in existing:
+        return
+    dupes = (
+        db.session.query(
+            Cart.user_id, Cart.product_id, func.min(Cart.id), func.sum(func.coalesce(Cart.quantity, 1))
+        )
+        .group_by(Cart.user_id, Cart.product_id)
+        .having(func.count(Cart.id) > 1)
+        .all()
+    )
+    for user_id, product_id, keep_id, quantity in dupes:
+        Cart.query.filter_by(id=keep_id).update({"quantity": quantity}, synchronize_session=False)
+        Cart.query.filter(
+            Cart.user_id == user_id, Cart.product_id == product_id, Cart.id != keep_id
+        ).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def create_product_fts():
+    if db.engine.dialect.name != "sqlite":
+        return
+    exists = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'")
+    ).first()
+    if not exists:
+        for ddl in PRODUCT_FTS_DDL:
+            db.session.execute(text(ddl))
+        # index the products that were already there
+        db.session.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+        db.session.commit()
@@ -1,26 +1,204 @@
 from flask import (
-    render_template, request, redirect, url_for, flash, session, current_app
+    render_template, request, redirect, url_for, flash, session, current_app, abort, jsonify
 )
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
-import os, uuid, random, smtplib
+from sqlalchemy import func, insert, literal, select, text, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
+import os, uuid, hashlib, hmac, queue, secrets, shutil, smtplib
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
-from datetime import datetime, timedelta
-from app import db, login_manager
-from app.models import User, Product, Cart, Order, OrderItem, Comment
+from datetime import datetime
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+from app import db, login_manager, cache
+from app.models import User, Product, Category, Cart, Order, OrderItem, Comment
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
+
+
+# SMTP handshakes take hundreds of ms, so mail goes out on worker threads
+# which share a small pool of logged-in connections
+_mail_pool = ThreadPoolExecutor(max_workers=4)
+_smtp_pool = queue.Queue(maxsize=4)
+
+
+def send_email(subject, recipient, body_text):
+    app = current_app._get_current_object()
+    _mail_pool.submit(_send_email_sync, app, subject, recipient, body_text)
+
+
+def _send_email_sync(app, subject, recipient, body_text):
+    server = app.config.get("MAIL_SERVER")
+    if not server:
+        print("----- EMAIL (console) -----")
+        print("To:", recipient)
+        print("Subject:", subject)
+        print(body_text)
+        print("---------------------------")
+        return
+
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = app.config.get("MAIL_DEFAULT_SENDER")
+    msg["To"] = recipient
+    msg.set_content(body_text)
+
+    smtp = None
+    try:
+        smtp = _checkout_smtp(app)
+        try:
+            smtp.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            smtp.close()
+            smtp = None
+            smtp = _smtp_connect(app)
+            smtp.send_message(msg)
+    except Exception as e:
+        print("Failed to send email:", e)
+        print(body_text)
+        # don't pool a connection in an unknown state
+        if smtp is not None:
+            smtp.close()
+        return
+
+    try:
+        _smtp_pool.put_nowait(smtp)
+    except queue.Full:
+        smtp.quit()
+
+
+def _smtp_connect(app):
+    server = app.config.get("MAIL_SERVER")
+    if app.config.get("MAIL_USE_TLS"):
+        smtp = smtplib.SMTP(server, app.config.get("MAIL_PORT"))
+        smtp.starttls()
+    else:
+        smtp = smtplib.SMTP_SSL(server, app.config.get("MAIL_PORT"))
+    smtp.login(app.config.get("MAIL_USERNAME"), app.config.get("MAIL_PASSWORD"))
+    return smtp
+
+
+def _checkout_smtp(app):
+    # reuse an authenticated connection if one is idle and still alive
+    try:
+        smtp = _smtp_pool.get_nowait()
+    except queue.Empty:
+        return _smtp_connect(app)
+    try:
+        if smtp.noop()[0] == 250:
+            return smtp
+    except (smtplib.SMTPException, OSError):
+        pass
+    smtp.close()
+    return _smtp_connect(app)
+
+
+RESET_MAX_AGE = 10 * 60  # password reset codes are valid for 10 minutes
+
+
+def _reset_serializer():
+    # built per call so the cookies are signed with the running app's SECRET_KEY
+    return URLSafeTimedSerializer(current_app.config["SECRET_KEY"])
+
+
+def _reset_code_mac(email, code):
+    key = current_app.config["SECRET_KEY"].encode()
+    return hmac.new(key, f"{email}:{code}".encode(), hashlib.sha256).hexdigest()
+
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp"}
+
+
+def unique_upload_name(filename):
+    _, ext = os.path.splitext(secure_filename(filename))
+    return f"{uuid.uuid4().hex}{ext}"
+
+
+def generate_order_number():
+    return f"ORD-{uuid.uuid4().hex[:10].upper()}"
+
+
+@cache.memoize(timeout=60)
+def latest_products(limit=12):
+    return Product.query.order_by(Product.created_at.desc()).limit(limit).all()
+
+
+@cache.memoize(timeout=60)
+def product_page(after=None, per_page=12):
+    """Returns up to per_page + 1 products older than the (created_at, id) cursor."""
+    q = Product.query
+    if after:
+        q = q.filter(tuple_(Product.created_at, Product.id) < tuple_(*after))
+    return q.order_by(Product.created_at.desc(), Product.id.desc()).limit(per_page + 1).all()
+
+
+def _parse_cursor(token):
+    if not token:
+        return None
+    try:
+        created_at, product_id = token.rsplit(",", 1)
+        return datetime.fromisoformat(created_at), int(product_id)
+    except ValueError:
+        abort(400)
+
+
+def _upsert_insert(model):
+    """INSERT construct that supports ON CONFLICT for the configured database."""
+    dialect = postgresql if db.engine.dialect.name == "postgresql" else sqlite
+    return dialect.insert(model)
+
+
+def _categories_named(names):
+    """Returns Category rows for the given names, creating the missing ones."""
+    names = list(dict.fromkeys(n.strip() for n in names if n and n.strip()))
+    if not names:
+        return []
+    # ON CONFLICT DO NOTHING so two uploads adding the same new category can't collide
+    db.session.execute(
+        _upsert_insert(Category)
+        .values([{"name": n} for n in names])
+        .on_conflict_do_nothing(index_elements=[Category.name])
+    )
+    by_name = {c.name: c for c in Category.query.filter(Category.name.in_(names))}
+    return [by_name[n] for n in names]
+
+
+def backfill_product_categories():
+    """Links every product to the Category rows named in its comma-separated categories."""
+    for p in Product.query.filter(Product.categories.isnot(None), Product.categories != ""):
+        p.category_list = _categories_named(p.categories.split(","))
+    db.session.commit()
+    cache.delete_memoized(category_names)
+
+
+@cache.memoize(timeout=60)
+def category_names():
+    return db.session.scalars(select(Category.name).order_by(Category.name)).all()
+
+
+def _cart_items_for(user_id):
+    return Cart.query.options(selectinload(Cart.product)).filter_by(user_id=user_id).all()
+
+
+def _cart_summary(user_id):
+    """Returns (line count, total price) of a cart without loading any rows."""
+    return (
+        db.session.query(func.count(Cart.id), func.coalesce(func.sum(Product.price * Cart.quantity), 0))
+        .join(Product, Product.id == Cart.product_id)
+        .filter(Cart.user_id == user_id)
+        .one()
+    )
 
 
 def register_routes(app):
     # --- Routes ---
     @app.route("/")
     def index():
-        products = Product.query.order_by(Product.created_at.desc()).limit(12).all()
-        return render_template("index.html", products=products)
+        return render_template("index.html", products=latest_products(), categories=category_names())
 
     @app.route("/register", methods=["GET", "POST"])
     def register():
@@ -60,6 +238,9 @@ def register_routes(app):
             password = request.form["password"]
             user = User.query.filter_by(email=email).first()
             if user and user.check_password(password):
+                if user.needs_rehash():
+                    user.set_password(password)
+                    db.session.commit()
                 login_user(user)
                 flash("Logged in successfully.", "success")
                 return redirect(url_for("index"))
@@ -108,7 +289,8 @@ def register_routes(app):
             categories = request.form.getlist("categories")
             if not categories:
                 categories = [request.form.get("productCategory", "")]
-            categories = ",".join([c for c in categories if c])
+            category_list = _categories_named(categories)
+            categories = ",".join(c.name for c in category_list)
 
             try:
                 price = float(request.form.get("price", 0.0))
@@ -120,8 +302,8 @@ def register_routes(app):
             for key in ["image1", "image2", "image3", "image4"]:
                 file = request.files.get(key)
                 if file and file.filename != "":
-                    filename = secure_filename(file.filename)
-                    filepath = os.path.join(app.config["UPLOAD_PATH"], filename)
+                    filename = unique_upload_name(file.filename)
+                    filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
                     file.save(filepath)
                     uploaded_files.append(filename)
                 else:
@@ -133,6 +315,7 @@ def register_routes(app):
                 description=desc,
                 specifications=specs,
                 categories=categories,
+                category_list=category_list,
                 price=price,
                 main_image=uploaded_files[0],
                 image2=uploaded_files[1],
@@ -143,6 +326,9 @@ def register_routes(app):
             # 4. Save to database
             db.session.add(p)
             db.session.commit()
+            cache.delete_memoized(latest_products)
+            cache.delete_memoized(product_page)
+            cache.delete_memoized(category_names)
 
             flash("✅ Product uploaded successfully!", "success")
             return redirect(url_for("upload_product"))
@@ -150,17 +336,58 @@ def register_routes(app):
         # 5. Render upload page
         return render_template("upload.html")
 
+    @app.route("/upload-product/stream", methods=["POST"])
+    @login_required
+    def upload_product_stream():
+        """
+        Attaches one image to an existing product from the raw request body.
+        Skips the multipart parser: ?product_id=<id>&slot=<image column>&filename=<name>
+        """
+        product_id = request.args.get("product_id", type=int)
+        slot = request.args.get("slot", "main_image")
+        original = request.args.get("filename", "")
+        if product_id is None or not original or slot not in ("main_image", "image2", "image3", "image4"):
+            abort(400)
+
+        filename = unique_upload_name(original)
+        if os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+            abort(400)
+        p = db.get_or_404(Product, product_id)
+
+        # copy to a temp name first so a failed or oversized upload leaves nothing behind
+        filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+        tmp_path = filepath + ".part"
+        try:
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(request.stream, f, length=1024 * 1024)
+            os.replace(tmp_path, filepath)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        setattr(p, slot, filename)
+        db.session.commit()
+        cache.delete_memoized(latest_products)
+        cache.delete_memoized(product_page)
+        return jsonify(filename=filename), 201
+
     @app.route("/products")
     def products():
-        page = int(request.args.get("page", 1))
         per = 12
-        q = Product.query.order_by(Product.created_at.desc())
-        pag = q.paginate(page=page, per_page=per, error_out=False)
-        return render_template("products.html", pagination=pag)
+        rows = product_page(_parse_cursor(request.args.get("after")), per)
+        items = rows[:per]
+        next_cursor = None
+        if len(rows) > per:
+            last = items[-1]
+            next_cursor = f"{last.created_at.isoformat()},{last.id}"
+        return render_template("products.html", products=items, next_cursor=next_cursor)
 
     @app.route("/product/<int:product_id>", methods=["GET", "POST"])
     def product_detail(product_id):
-        p = Product.query.get_or_404(product_id)
+        p = db.session.get(Product, product_id, options=[selectinload(Product.comments)])
+        if p is None:
+            abort(404)
         if request.method == "POST":
             body = request.form["comment"]
             if not body:
@@ -178,19 +405,19 @@ def register_routes(app):
             return redirect(request.url)
 
         images = [p.main_image] + [img for img in (p.image2, p.image3, p.image4) if img]
-        comments = Comment.query.filter_by(product_id=p.id).order_by(Comment.created_at.desc()).all()
-        return render_template("index.html", product=p, images=images, comments=comments)
+        return render_template("index.html", product=p, images=images, comments=p.comments)
 
     @app.route("/cart/add/<int:product_id>", methods=["POST"])
     @login_required
     def cart_add(product_id):
         qty = int(request.form.get("quantity", 1))
-        item = Cart.query.filter_by(user_id=current_user.id, product_id=product_id).first()
-        if item:
-            item.quantity += qty
-        else:
-            item = Cart(user_id=current_user.id, product_id=product_id, quantity=qty)
-            db.session.add(item)
+        # single atomic INSERT ... ON CONFLICT instead of a read-modify-write
+        stmt = _upsert_insert(Cart).values(user_id=current_user.id, product_id=product_id, quantity=qty)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Cart.user_id, Cart.product_id],
+            set_={"quantity": Cart.quantity + stmt.excluded.quantity},
+        )
+        db.session.execute(stmt)
         db.session.commit()
         flash("Product added to your cart!", "success")
         return redirect(request.referrer or url_for("cart"))
@@ -199,33 +426,38 @@ def register_routes(app):
     @app.route("/cart")
     @login_required
     def cart():
-        cart_items = Cart.query.filter_by(user_id=current_user.id).all()
+        cart_items = _cart_items_for(current_user.id)
         total = sum((item.product.price if item.product else 0) * item.quantity for item in cart_items)
         return render_template("cart.html", items=cart_items, total=total)
 
     @app.route("/cart/remove/<int:item_id>")
     @login_required
     def cart_remove(item_id):
-        item = Cart.query.filter_by(item_id=item_id, user_id=current_user.id).first_or_404()
-        if item:
-            db.session.delete(item)
-            db.session.commit()
-            flash("Item removed from your cart.", "info")
+        item = db.get_or_404(Cart, item_id)
+        if item.user_id != current_user.id:
+            abort(404)
+        db.session.delete(item)
+        db.session.commit()
+        flash("Item removed from your cart.", "info")
         return redirect(url_for("cart"))
 
     @app.route("/cart/update", methods=["POST"])
+    @login_required
     def cart_update():
-        cart = {}
+        # the Cart table is the only cart state; nothing is kept in the session cookie
         for key, val in request.form.items():
             if key.startswith("qty_"):
-                pid = key.split("_", 1)[1]
                 try:
+                    product_id = int(key.split("_", 1)[1])
                     q = int(val)
-                    if q > 0:
-                        cart[pid] = q
-                except:
-                    pass
-        session["cart"] = cart
+                except ValueError:
+                    continue
+                rows = Cart.query.filter_by(user_id=current_user.id, product_id=product_id)
+                if q > 0:
+                    rows.update({"quantity": q}, synchronize_session=False)
+                else:
+                    rows.delete(synchronize_session=False)
+        db.session.commit()
         flash("Cart updated", "success")
         return redirect(url_for("cart"))
 
@@ -236,7 +468,7 @@ def register_routes(app):
         Shows order confirmation page before final checkout.
         Displays user info, shipping address, cart items, and payment options.
         """
-        cart_items = Cart.query.filter_by(user_id=current_user.id).all()
+        cart_items = _cart_items_for(current_user.id)
         if not cart_items:
             flash("Your cart is empty!", "warning")
             return redirect(url_for("cart"))
@@ -268,8 +500,8 @@ def register_routes(app):
         """
         Final checkout — creates the order after the user confirms details and payment method.
         """
-        cart_items = Cart.query.filter_by(user_id=current_user.id).all()
-        if not cart_items:
+        line_count, total = _cart_summary(current_user.id)
+        if not line_count:
             flash("Your cart is empty!", "warning")
             return redirect(url_for("cart"))
 
@@ -278,8 +510,6 @@ def register_routes(app):
             flash("Please confirm your order first.", "warning")
             return redirect(url_for("cart_confirm"))
 
-        total = sum((item.product.price or 0) * item.quantity for item in cart_items)
-
         # Create new order
         order = Order(
             order_number=generate_order_number(),
@@ -289,20 +519,21 @@ def register_routes(app):
             status="Processing" if payment_method == "cod" else "Awaiting Payment",
         )
         db.session.add(order)
-        db.session.commit()
+        db.session.flush()  # assigns order.id
 
-        # Add order items
-        for item in cart_items:
-            order_item = OrderItem(
-                order_id=order.id,
-                product_id=item.product.id,
-                user_id=current_user.id,
-                product_name=item.product.name,
-                unit_price=item.product.price,
-                quantity=item.quantity,
+        # Copy the cart lines into order items with one INSERT ... SELECT
+        lines = (
+            select(literal(order.id), Cart.product_id, Cart.user_id, Product.name, Product.price, Cart.quantity)
+            .join(Product, Product.id == Cart.product_id)
+            .where(Cart.user_id == current_user.id)
+        )
+        db.session.execute(
+            insert(OrderItem).from_select(
+                ["order_id", "product_id", "user_id", "product_name", "unit_price", "quantity"], lines
             )
-            db.session.add(order_item)
-            db.session.delete(item)  # Clear from cart after ordering
+        )
+        # Clear the cart with a single DELETE
+        Cart.query.filter_by(user_id=current_user.id).delete(synchronize_session=False)
         db.session.commit()
 
         # Payment handling
@@ -323,13 +554,20 @@ def register_routes(app):
     @app.route("/order/<int:order_id>/confirmation")
     @login_required
     def order_confirmation(order_id):
-        order = Order.query.get_or_404(order_id)
+        order = db.get_or_404(Order, order_id)
+        if order.user_id != current_user.id:
+            abort(404)
         return render_template("order.html", order=order)
 
     @app.route("/orders")
     @login_required
     def orders():
-        orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
+        orders = (
+            Order.query.options(selectinload(Order.items))
+            .filter_by(user_id=current_user.id)
+            .order_by(Order.created_at.desc())
+            .all()
+        )
         return render_template("order.html", orders=orders)
 
     @app.route("/forgot-password", methods=["GET", "POST"])
@@ -337,15 +575,15 @@ def register_routes(app):
         if request.method == "POST":
             email = request.form["email"]
             user = User.query.filter_by(email=email).first()
+            resp = redirect(url_for("verify_code"))
 
             if user:
                 # Generate a 6-digit verification code
-                code = str(random.randint(100000, 999999))
+                code = str(secrets.randbelow(900000) + 100000)
 
-                # Store the code and its expiry (10 min) in session (or database)
-                session["reset_email"] = email
-                session["reset_code"] = code
-                session["reset_expiry"] = (datetime.utcnow() + timedelta(minutes=10)).isoformat()
+                # Only a keyed MAC of the code goes into the signed cookie; it expires after 10 min
+                token = _reset_serializer().dumps({"email": email, "code_mac": _reset_code_mac(email, code)}, salt="reset-code")
+                resp.set_cookie("reset_token", token, max_age=RESET_MAX_AGE, httponly=True, samesite="Lax")
 
                 # Send code via email
                 body = f"""Your password reset code is: {code}
@@ -355,7 +593,7 @@ def register_routes(app):
                 send_email("MyShop Password Reset Code", user.email, body)
 
             flash("If an account exists, a verification code has been sent to your email.", "info")
-            return redirect(url_for("verify_code"))
+            return resp
 
         return render_template("forgot_password.html")
 
@@ -364,37 +602,40 @@ def register_routes(app):
     def verify_code():
         if request.method == "POST":
             code = request.form.get("code", "").strip()
-            saved_code = session.get("reset_code")
-            expiry_str = session.get("reset_expiry")
-
-            if not saved_code or not expiry_str:
-                flash("No code found. Please request a new one.", "danger")
-                return redirect(url_for("forgot_password"))
 
-            expiry = datetime.fromisoformat(expiry_str)
-            if datetime.utcnow() > expiry:
+            try:
+                data = _reset_serializer().loads(request.cookies.get("reset_token", ""), salt="reset-code", max_age=RESET_MAX_AGE)
+            except SignatureExpired:
                 flash("Your verification code has expired. Please request a new one.", "danger")
                 return redirect(url_for("forgot_password"))
+            except BadSignature:
+                flash("No code found. Please request a new one.", "danger")
+                return redirect(url_for("forgot_password"))
 
-            if code != saved_code:
+            if not hmac.compare_digest(_reset_code_mac(data["email"], code), data["code_mac"]):
                 flash("Invalid verification code. Please try again.", "warning")
                 return redirect(url_for("verify_code"))
 
             # Code is valid — allow password reset
             flash("Code verified. Please set a new password.", "success")
-            return redirect(url_for("reset_password"))
+            resp = redirect(url_for("reset_password"))
+            resp.delete_cookie("reset_token")
+            token = _reset_serializer().dumps({"email": data["email"]}, salt="reset-verified")
+            resp.set_cookie("reset_verified", token, max_age=RESET_MAX_AGE, httponly=True, samesite="Lax")
+            return resp
 
         return render_template("verify_code.html")
 
 
     @app.route("/reset-password", methods=["GET", "POST"])
     def reset_password():
-        email = session.get("reset_email")
-        if not email:
+        try:
+            data = _reset_serializer().loads(request.cookies.get("reset_verified", ""), salt="reset-verified", max_age=RESET_MAX_AGE)
+        except BadSignature:
             flash("Session expired. Please restart the password reset process.", "danger")
             return redirect(url_for("forgot_password"))
 
-        user = User.query.filter_by(email=email).first_or_404()
+        user = User.query.filter_by(email=data["email"]).first_or_404()
 
         if request.method == "POST":
             new = request.form["newPassword"]
@@ -407,26 +648,36 @@ def register_routes(app):
             user.set_password(new)
             db.session.commit()
 
-            # Clear session
-            session.pop("reset_email", None)
-            session.pop("reset_code", None)
-            session.pop("reset_expiry", None)
-
             flash("Your password has been reset successfully. Please log in.", "success")
-            return redirect(url_for("login"))
+            resp = redirect(url_for("login"))
+            resp.delete_cookie("reset_verified")
+            return resp
 
         return render_template("reset_password.html", user=user)
 
     @app.route("/search")
     def search():
         query = request.args.get("q", "").strip()
+        category = request.args.get("category", "").strip()
         products = []
 
-        if query:
+        if category:
+            # indexed join through product_categories instead of a substring scan
+            products = Product.query.join(Product.category_list).filter(Category.name == category).all()
+            query = category
+        elif query and db.engine.dialect.name == "sqlite":
+            # quote every word so user input can't break FTS5 syntax; "*" keeps prefix matches
+            match = " ".join('"{}"*'.format(word.replace('"', '""')) for word in query.split())
+            ids = db.session.execute(
+                text("SELECT rowid FROM products_fts WHERE products_fts MATCH :q ORDER BY bm25(products_fts)"),
+                {"q": match},
+            ).scalars().all()
+            by_id = {p.id: p for p in Product.query.filter(Product.id.in_(ids))}
+            products = [by_id[i] for i in ids if i in by_id]
+        elif query:
             products = Product.query.filter(
                 (Product.name.ilike(f"%{query}%")) |
-                (Product.description.ilike(f"%{query}%")) |
-                (Product.categories.ilike(f"%{query}%"))
+                (Product.description.ilike(f"%{query}%"))
             ).all()
 
         return render_template("search_results.html", query=query, products=products)
@@ -457,6 +708,12 @@ def register_routes(app):
         db.create_all()
         print("✅ Database initialized successfully.")
 
+    @app.cli.command("migrate-categories")
+    def migrate_categories_command():
+        """One-shot: fill product_categories from the comma-separated Product.categories."""
+        backfill_product_categories()
+        print("✅ Categories migrated successfully.")
+
     @app.errorhandler(404)
     def not_found(e):
         return render_template("404.html"), 404
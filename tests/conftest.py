@@ -0,0 +1,58 @@
+import pytest
+from sqlalchemy import event
+
+from app import create_app, db
+from app.models import Product, User
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setenv("QUERY_GUARD", "True")
+    app = create_app()
+    app.config["TESTING"] = True
+
+    with app.app_context():
+        user = User(email="a@b.c", first_name="A")
+        user.set_password("pw")
+        db.session.add(user)
+        for i in range(5):
+            db.session.add(Product(
+                name=f"P{i}", description="desc widget", categories="shoes,red",
+                price=1.5 + i, main_image="x.jpg",
+            ))
+        db.session.commit()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.post("/login", data={"email": "a@b.c", "password": "pw"})
+    return client
+
+
+@pytest.fixture
+def count_queries(app):
+    """Return a function that runs a request and gives back (response, number of SQL statements)."""
+    statements = []
+
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", _count)
+
+    def run(request):
+        statements.clear()
+        response = request()
+        return response, len(statements)
+
+    yield run
+    event.remove(engine, "before_cursor_execute", _count)
@@ -0,0 +1,17 @@
+from app import create_app
+
+
+def test_startup_backfills_categories(app):
+    # the fixture seeds products after startup, so they have no category links yet
+    client = create_app().test_client()
+    assert b"category=shoes" in client.get("/").data
+
+    body = client.get("/search?category=red").get_data(as_text=True)
+    assert all(f"P{i}" in body for i in range(5))
+
+
+def test_backfill_is_skipped_once_linked(app):
+    create_app()
+    client = create_app().test_client()
+    body = client.get("/search?category=shoes").get_data(as_text=True)
+    assert all(f"P{i}" in body for i in range(5))
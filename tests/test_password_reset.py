@@ -0,0 +1,85 @@
+import re
+
+import pytest
+
+from app import db
+from app.models import User
+
+
+@pytest.fixture
+def sent_codes(monkeypatch):
+    codes = []
+
+    def fake_send_email(subject, recipient, body_text):
+        codes.append(re.search(r"\d{6}", body_text).group())
+
+    monkeypatch.setattr("app.routes.send_email", fake_send_email)
+    return codes
+
+
+def request_code(client):
+    response = client.post("/forgot-password", data={"email": "a@b.c"})
+    assert response.headers["Location"].endswith("/verify-code")
+    return response
+
+
+def test_unknown_email_sets_no_cookie(app, sent_codes):
+    client = app.test_client()
+    client.post("/forgot-password", data={"email": "nobody@b.c"})
+    assert sent_codes == []
+    assert client.get_cookie("reset_token") is None
+
+
+def test_wrong_code(app, sent_codes):
+    client = app.test_client()
+    request_code(client)
+    wrong = "100000" if sent_codes[0] != "100000" else "100001"
+    response = client.post("/verify-code", data={"code": wrong})
+    assert response.headers["Location"].endswith("/verify-code")
+    assert client.get_cookie("reset_verified") is None
+
+
+def test_correct_code_resets_password(app, sent_codes):
+    client = app.test_client()
+    request_code(client)
+    response = client.post("/verify-code", data={"code": sent_codes[0]})
+    assert response.headers["Location"].endswith("/reset-password")
+    assert client.get_cookie("reset_token") is None
+
+    assert client.get("/reset-password").status_code == 200
+    response = client.post("/reset-password", data={"newPassword": "new", "confirmPassword": "new"})
+    assert response.headers["Location"].endswith("/login")
+    assert client.get_cookie("reset_verified") is None
+
+    with app.app_context():
+        assert db.session.execute(db.select(User)).scalar_one().check_password("new")
+
+
+def test_reset_password_requires_verified_cookie(app, sent_codes):
+    client = app.test_client()
+    request_code(client)
+    # holding only the code cookie is not enough to reach the reset form
+    response = client.get("/reset-password")
+    assert response.headers["Location"].endswith("/forgot-password")
+
+
+def test_verify_without_cookie(app):
+    client = app.test_client()
+    response = client.post("/verify-code", data={"code": "123456"})
+    assert response.headers["Location"].endswith("/forgot-password")
+
+
+def test_expired_code(app, sent_codes, monkeypatch):
+    client = app.test_client()
+    request_code(client)
+    monkeypatch.setattr("app.routes.RESET_MAX_AGE", -1)
+    response = client.post("/verify-code", data={"code": sent_codes[0]})
+    assert response.headers["Location"].endswith("/forgot-password")
+
+
+def test_cookies_follow_the_running_apps_secret(app, sent_codes):
+    client = app.test_client()
+    request_code(client)
+    app.config["SECRET_KEY"] = "rotated"
+    response = client.post("/verify-code", data={"code": sent_codes[0]})
+    assert response.headers["Location"].endswith("/forgot-password")
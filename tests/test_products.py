@@ -0,0 +1,12 @@
+from app import db
+from app.models import Product
+
+
+def test_products_page_without_image(app, client):
+    with app.app_context():
+        db.session.add(Product(name="No image", description="plain", categories="", price=2.0))
+        db.session.commit()
+
+    response = client.get("/products")
+    assert response.status_code == 200
+    assert b"No image" in response.data
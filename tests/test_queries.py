@@ -0,0 +1,71 @@
+import pytest
+from sqlalchemy.exc import InvalidRequestError
+
+from app import db
+from app.models import Product
+
+
+def fill_cart(client):
+    for product_id in range(1, 5):
+        client.post(f"/cart/add/{product_id}", data={"quantity": 2})
+
+
+def checkout(client):
+    fill_cart(client)
+    client.post("/cart/confirm", data={"payment_method": "cod"})
+    return client.post("/cart/checkout")
+
+
+def test_products_page(client, count_queries):
+    response, queries = count_queries(lambda: client.get("/products"))
+    assert response.status_code == 200
+    assert queries <= 2
+
+
+def test_product_detail(client, count_queries):
+    response, queries = count_queries(lambda: client.get("/product/1"))
+    assert response.status_code == 200
+    assert queries <= 3
+
+
+def test_cart(client, count_queries):
+    fill_cart(client)
+    response, queries = count_queries(lambda: client.get("/cart"))
+    assert response.status_code == 200
+    assert queries <= 3
+
+
+def test_checkout(client, count_queries):
+    fill_cart(client)
+    client.post("/cart/confirm", data={"payment_method": "cod"})
+    response, queries = count_queries(lambda: client.post("/cart/checkout"))
+    assert response.status_code == 302
+    assert queries <= 7
+
+
+def test_orders(client, count_queries):
+    checkout(client)
+    checkout(client)
+    response, queries = count_queries(lambda: client.get("/orders"))
+    assert response.status_code == 200
+    assert queries <= 3
+
+
+def test_order_confirmation(client, count_queries):
+    location = checkout(client).headers["Location"]
+    response, queries = count_queries(lambda: client.get(location))
+    assert response.status_code == 200
+    assert queries <= 3
+
+
+def test_lazy_load_raises_during_request(app):
+    with app.test_request_context():
+        product = db.session.get(Product, 1)
+        with pytest.raises(InvalidRequestError):
+            product.comments
+
+
+def test_query_budget_fails_under_testing(app, client):
+    app.config["QUERY_BUDGET"] = 1
+    with pytest.raises(AssertionError):
+        client.get("/cart")